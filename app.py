@@ -1,17 +1,30 @@
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, Response, g, request, jsonify, send_from_directory, send_file, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.utils import secure_filename
 import os
 import json
+import re
 from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
 import io
 import tempfile
 import sqlite3
 import hashlib
+import hmac
 import secrets
 import uuid
+import threading
+import queue
+from collections import deque
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
 
 try:
     import librosa
@@ -20,6 +33,18 @@ try:
 except ImportError:
     HAS_AUDIO_LIBS = False
 
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+try:
+    import pypdfium2 as pdfium
+    HAS_PDFIUM = True
+except ImportError:
+    HAS_PDFIUM = False
+
 try:
     from PyPDF2 import PdfReader
     HAS_PDF = True
@@ -35,32 +60,180 @@ try:
 except ImportError:
     HAS_REPORTLAB = False
 
+if HAS_REPORTLAB:
+    # Built once; ReportLab only reads these while laying out a document
+    PDF_STYLES = getSampleStyleSheet()
+    PDF_TITLE_STYLE = ParagraphStyle(
+        'CustomTitle',
+        parent=PDF_STYLES['Heading1'],
+        fontSize=24,
+        textColor='#000000',
+        spaceAfter=30,
+        alignment=1
+    )
+
 app = Flask(__name__, static_folder='.')
 CORS(app)
 
+# ============ JSON SERIALIZATION ============
+
+def json_dumps(obj):
+    """Serialize obj to a JSON string, using orjson when available"""
+    if HAS_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj)
+
+def json_dumps_bytes(obj):
+    """Serialize obj to UTF-8 JSON bytes for use as an HTTP request body"""
+    if HAS_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj).encode()
+
+def json_loads(s):
+    """Parse a JSON string or bytes, using orjson when available"""
+    if HAS_ORJSON:
+        return orjson.loads(s)
+    return json.loads(s)
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson for jsonify and request.json"""
+    
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+if HAS_ORJSON:
+    app.json = ORJSONProvider(app)
+
+# JSON API bodies above this are rejected up front. Endpoints taking multipart
+# uploads are never pre-read; they bound any JSON they accept themselves
+MAX_JSON_BODY = 2 * 1024 * 1024
+UPLOAD_ENDPOINTS = {'submit_pdf', 'create_teacher_session', 'save_audio_recording'}
+# Older save-audio clients post the recording as a base64 data URL in JSON
+MAX_AUDIO_JSON_BODY = 4 * MAX_JSON_BODY
+
+def read_body(limit):
+    """Read the request body up to limit bytes; None if it is larger"""
+    # Neither Content-Type nor Content-Length can be trusted: get_json() parses any
+    # body, and chunked requests carry no length
+    if (request.content_length or 0) > limit:
+        return None
+    chunks = []
+    remaining = limit + 1
+    while remaining > 0:
+        chunk = request.stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    if remaining <= 0:
+        return None
+    return b''.join(chunks)
+
+@app.before_request
+def limit_json_body():
+    """Pre-read the body of every non-upload endpoint, rejecting ones over MAX_JSON_BODY"""
+    if request.method in ('GET', 'HEAD', 'OPTIONS') or request.endpoint in UPLOAD_ENDPOINTS:
+        return None
+    body = read_body(MAX_JSON_BODY)
+    if body is None:
+        return jsonify({'error': 'Request body too large'}), 413
+    g.json_body = body
+    return None
+
+def get_json():
+    """Parse the size-checked request body, without caching it on the request"""
+    body = g.pop('json_body', None)
+    if body is None:
+        raise ValueError('Request body was not size-checked')
+    return json_loads(body)
+
 # Database configuration
 DATABASE = 'ai_platform.db'
+DB_POOL_SIZE = 8  # idle connections kept open between requests
 SESSIONS_TIMEOUT = 24  # hours
-
-# Store session data
-sessions = {}
-teacher_sessions = {}
-temp_file_store = {}
-auth_tokens = {}  # token -> user_id mapping
+SCHEMA_VERSION = 4  # bump when init_db() gains new tables or indexes
+MAX_CONVERSATION_HISTORY = 50  # messages kept per interview session
+CONTEXT_TOKEN_BUDGET = 6000  # syllabus + PYQ tokens sent with teach/paper prompts
+CHARS_PER_TOKEN = 4  # rough average for English text; used to size CONTEXT_TOKEN_BUDGET
+
+CORRECTION_MARKER = 'correction:'
+_CORRECTION_RE = re.compile(re.escape(CORRECTION_MARKER), re.IGNORECASE)
+# Rest of the line after a grading reply's score marker
+_OVERALL_SCORE_RE = re.compile(r'OVERALL_SCORE:(.*)')
+_SCORE_RE = re.compile(r'SCORE:(.*)')
+
+# Store session data; bounded and expired after SESSIONS_TIMEOUT
+sessions = TTLCache(maxsize=10_000, ttl=SESSIONS_TIMEOUT * 3600)
+temp_file_store = TTLCache(maxsize=10_000, ttl=SESSIONS_TIMEOUT * 3600)
+session_store_lock = threading.RLock()
+# token -> {'user_id', 'user_type'}; bounded and expired after SESSIONS_TIMEOUT
+auth_tokens = TTLCache(maxsize=100_000, ttl=SESSIONS_TIMEOUT * 3600)
+auth_tokens_lock = threading.RLock()
+# sha256(api_key) -> (valid, error) from the last definitive /api/test-key check
+key_validation_cache = TTLCache(maxsize=10_000, ttl=300)
+key_validation_lock = threading.Lock()
+# paper_id -> decoded questions list; papers are never edited, so entries simply age out
+questions_cache = TTLCache(maxsize=1024, ttl=300)
+questions_cache_lock = threading.Lock()
 
 # ============ DATABASE INITIALIZATION ============
 
-def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
+# LIFO so the most recently used (warmest) connection is handed out first
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def connect_db():
+    """Open a new tuned database connection"""
+    # Autocommit mode: writers open their own transactions with BEGIN, and a
+    # larger statement cache keeps every hot query prepared on this connection.
+    # Pooled connections move between threads but are only used by one at a time.
+    conn = sqlite3.connect(DATABASE, cached_statements=256, isolation_level=None,
+                           check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # Per-connection tuning; journal_mode=WAL is persisted by init_db()
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-20000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
     return conn
 
+def get_db():
+    """Get the app context's database connection, checking one out of the pool on first use"""
+    conn = g.get('db')
+    if conn is None:
+        try:
+            conn = _db_pool.get_nowait()
+        except queue.Empty:
+            conn = connect_db()
+        g.db = conn
+    return conn
+
+@app.teardown_appcontext
+def release_db(exc):
+    """Return the context's connection to the pool, discarding any open transaction"""
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
 def init_db():
     """Initialize database schema"""
     conn = get_db()
     cursor = conn.cursor()
     
+    # WAL lets readers proceed while a writer commits; the mode is stored in the db file
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
     # Users table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -149,12 +322,131 @@ def init_db():
     )
     ''')
     
+    # One row per saved recording; learning_sessions.audio_recordings only holds legacy entries
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS learning_recordings (
+        id INTEGER PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        audio_size INTEGER NOT NULL,
+        transcript TEXT,
+        FOREIGN KEY (session_id) REFERENCES learning_sessions(id)
+    )
+    ''')
+    
+    # Teacher study sessions (syllabus/PYQ context); children hold the per-session history
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS teacher_sessions (
+        id TEXT PRIMARY KEY,
+        syllabus TEXT NOT NULL,
+        pyq TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        questions_asked INTEGER DEFAULT 0,
+        papers_generated INTEGER DEFAULT 0,
+        answers_graded INTEGER DEFAULT 0
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS teacher_messages (
+        id INTEGER PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (session_id) REFERENCES teacher_sessions(id)
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS teacher_papers (
+        id TEXT PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        content TEXT NOT NULL,
+        num_questions INTEGER,
+        difficulty TEXT,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (session_id) REFERENCES teacher_sessions(id)
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS teacher_graded_answers (
+        id TEXT PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        student_name TEXT,
+        question TEXT,
+        answer TEXT,
+        grading TEXT,
+        score TEXT,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (session_id) REFERENCES teacher_sessions(id)
+    )
+    ''')
+    
+    # Indexes for the foreign-key columns the teacher/student queries filter on
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_qp_teacher ON question_papers(teacher_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_assignments_student ON assignments(student_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_assignments_paper ON assignments(paper_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_answers_paper ON student_answers(paper_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_answers_student ON student_answers(student_id)')
+    # (assignment_id, student_id) is the submit_pdf lookup; its prefix serves assignment_id-only filters
+    cursor.execute('DROP INDEX IF EXISTS idx_answers_assignment')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_answers_assignment_student ON student_answers(assignment_id, student_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_learning_recordings_session ON learning_recordings(session_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_teacher_sessions_created ON teacher_sessions(created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_teacher_messages_session ON teacher_messages(session_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_teacher_papers_session ON teacher_papers(session_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_teacher_graded_session ON teacher_graded_answers(session_id)')
+    
+    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
     conn.commit()
-    conn.close()
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def ensure_schema():
+    """Run init_db() once per process, and only if the db is behind SCHEMA_VERSION"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            version = get_db().execute('PRAGMA user_version').fetchone()[0]
+            if version < SCHEMA_VERSION:
+                init_db()
+            _schema_ready = True
+
+@app.before_request
+def bootstrap_db():
+    """Make sure the schema exists before the first request touches it"""
+    ensure_schema()
+
+# Cost tuned to keep a login verify around 50-100ms
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
 
 def hash_password(password):
-    """Hash password using SHA256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash password using argon2id"""
+    return password_hasher.hash(password)
+
+def is_legacy_hash(password_hash):
+    """Check for an unsalted SHA256 hash from before the argon2 migration"""
+    return not password_hash.startswith('$argon2')
+
+def verify_password(password_hash, password):
+    """Check password against a stored argon2 or legacy SHA256 hash"""
+    if is_legacy_hash(password_hash):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(password_hash, legacy)
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerifyMismatchError, InvalidHashError):
+        return False
+
+def now_stamp():
+    """Snapshot the clock once as (epoch seconds, ISO string) for ids and created_at"""
+    now = datetime.now()
+    return now.timestamp(), now.isoformat()
 
 def generate_token():
     """Generate secure token"""
@@ -164,8 +456,94 @@ def generate_uuid():
     """Generate UUID"""
     return str(uuid.uuid4())
 
-# Initialize database on startup
-init_db()
+# ============ GEMINI CLIENT ============
+
+GEMINI_MODEL_URL = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash'
+GEMINI_GENERATE_URL = f'{GEMINI_MODEL_URL}:generateContent'
+GEMINI_STREAM_URL = f'{GEMINI_MODEL_URL}:streamGenerateContent'
+GEMINI_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Connect fails fast. The read timeout default suits short prompts; call sites that
+# ask for long generations pass a read_timeout sized to their max_output_tokens
+GEMINI_CONNECT_TIMEOUT = 3
+GEMINI_READ_TIMEOUT = float(os.environ.get('GEMINI_READ_TIMEOUT', 15))
+
+# Shared session so every Gemini call reuses pooled keep-alive connections
+# to the same host instead of paying a new TCP+TLS handshake per request
+GEMINI_SESSION = requests.Session()
+GEMINI_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    # Read timeouts and 5xx/429 are re-raced here (with jittered exponential backoff)
+    # rather than in call_gemini, so a call is never retried at two layers
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.25,
+        backoff_jitter=0.1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['POST']),
+        raise_on_status=False
+    )
+))
+
+# Outbound Gemini calls run here so independent prompts can be issued concurrently
+GEMINI_EXECUTOR = ThreadPoolExecutor(max_workers=64, thread_name_prefix='gemini')
+
+def submit_gemini(api_key, prompt, temperature=0.7, max_output_tokens=2000, read_timeout=None, stream=False):
+    """Queue a Gemini call on GEMINI_EXECUTOR and return a Future for its response"""
+    return GEMINI_EXECUTOR.submit(_post_gemini, api_key, prompt, temperature, max_output_tokens, read_timeout, stream)
+
+def call_gemini(api_key, prompt, temperature=0.7, max_output_tokens=2000, read_timeout=None, stream=False):
+    """Send a single-turn prompt to Gemini and return the raw HTTP response
+    
+    With stream=True the reply is requested as server-sent events and the
+    body is left unread so it can be relayed with iter_gemini_text().
+    """
+    return submit_gemini(api_key, prompt, temperature, max_output_tokens, read_timeout, stream).result()
+
+def _post_gemini(api_key, prompt, temperature, max_output_tokens, read_timeout, stream):
+    """POST a generateContent request on the shared session (runs on GEMINI_EXECUTOR)"""
+    body = {
+        'contents': [{
+            'parts': [{'text': prompt}]
+        }],
+        'generationConfig': {
+            'temperature': temperature,
+            'maxOutputTokens': max_output_tokens,
+        }
+    }
+    if stream:
+        url, params = GEMINI_STREAM_URL, {'alt': 'sse'}
+    else:
+        url, params = GEMINI_GENERATE_URL, None
+    # Key goes in a header so it stays out of URLs that end up in logs and tracebacks
+    return GEMINI_SESSION.post(
+        url,
+        params=params,
+        data=json_dumps_bytes(body),
+        headers={**GEMINI_JSON_HEADERS, 'x-goog-api-key': api_key},
+        timeout=(GEMINI_CONNECT_TIMEOUT, read_timeout or GEMINI_READ_TIMEOUT),
+        stream=stream
+    )
+
+def iter_gemini_text(response):
+    """Yield text fragments from a streamed Gemini response as they arrive"""
+    try:
+        for line in response.iter_lines():
+            if not line.startswith(b'data:'):
+                continue
+            chunk = json_loads(line[5:])
+            for candidate in chunk.get('candidates', []):
+                for part in candidate.get('content', {}).get('parts', []):
+                    if part.get('text'):
+                        yield part['text']
+    finally:
+        response.close()
+
+def sse_event(data, event=None):
+    """Format a server-sent event carrying a JSON payload"""
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {json_dumps(data)}\n\n'
 
 # ============ AUTHENTICATION MIDDLEWARE ============
 
@@ -175,11 +553,14 @@ def require_auth(f):
     def decorated_function(*args, **kwargs):
         token = request.headers.get('Authorization', '').replace('Bearer ', '')
         
-        if not token or token not in auth_tokens:
+        with auth_tokens_lock:
+            auth = auth_tokens.get(token) if token else None
+        
+        if not auth:
             return jsonify({'error': 'Unauthorized'}), 401
         
-        user_id = auth_tokens[token]
-        request.user_id = user_id
+        request.user_id = auth['user_id']
+        request.user_type = auth['user_type']
         return f(*args, **kwargs)
     
     return decorated_function
@@ -189,13 +570,7 @@ def require_teacher(f):
     @wraps(f)
     @require_auth
     def decorated_function(*args, **kwargs):
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_type FROM users WHERE id = ?', (request.user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        
-        if not user or user['user_type'] != 'teacher':
+        if request.user_type != 'teacher':
             return jsonify({'error': 'Teacher access required'}), 403
         
         return f(*args, **kwargs)
@@ -207,13 +582,7 @@ def require_student(f):
     @wraps(f)
     @require_auth
     def decorated_function(*args, **kwargs):
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_type FROM users WHERE id = ?', (request.user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        
-        if not user or user['user_type'] != 'student':
+        if request.user_type != 'student':
             return jsonify({'error': 'Student access required'}), 403
         
         return f(*args, **kwargs)
@@ -236,7 +605,7 @@ def serve_static(path):
 def register():
     """Register new user"""
     try:
-        data = request.json
+        data = get_json()
         username = data.get('username', '').strip()
         email = data.get('email', '').strip()
         password = data.get('password', '')
@@ -258,7 +627,6 @@ def register():
         # Check if user exists
         cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email))
         if cursor.fetchone():
-            conn.close()
             return jsonify({'error': 'Username or email already exists'}), 409
         
         # Create new user
@@ -272,7 +640,6 @@ def register():
         ''', (user_id, username, email, password_hash, user_type, created_at))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -289,7 +656,7 @@ def register():
 def login():
     """Login user and return auth token"""
     try:
-        data = request.json
+        data = get_json()
         username_or_email = data.get('username', '').strip()
         password = data.get('password', '')
         
@@ -305,14 +672,20 @@ def login():
         ''', (username_or_email, username_or_email))
         
         user = cursor.fetchone()
-        conn.close()
         
-        if not user or user['password_hash'] != hash_password(password):
+        if not user or not verify_password(user['password_hash'], password):
             return jsonify({'error': 'Invalid username or password'}), 401
         
+        # Upgrade legacy or outdated hashes now that we have the plaintext
+        if is_legacy_hash(user['password_hash']) or password_hasher.check_needs_rehash(user['password_hash']):
+            cursor.execute('UPDATE users SET password_hash = ? WHERE id = ?',
+                          (hash_password(password), user['id']))
+            conn.commit()
+        
         # Generate and store token
         token = generate_token()
-        auth_tokens[token] = user['id']
+        with auth_tokens_lock:
+            auth_tokens[token] = {'user_id': user['id'], 'user_type': user['user_type']}
         
         return jsonify({
             'success': True,
@@ -332,8 +705,8 @@ def logout():
     """Logout user"""
     try:
         token = request.headers.get('Authorization', '').replace('Bearer ', '')
-        if token in auth_tokens:
-            del auth_tokens[token]
+        with auth_tokens_lock:
+            auth_tokens.pop(token, None)
         return jsonify({'success': True, 'message': 'Logged out successfully'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -347,7 +720,6 @@ def verify_token():
         cursor = conn.cursor()
         cursor.execute('SELECT id, username, email, user_type FROM users WHERE id = ?', (request.user_id,))
         user = cursor.fetchone()
-        conn.close()
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -367,31 +739,30 @@ def verify_token():
 def test_api_key():
     """Test if the Gemini API key is valid"""
     try:
-        data = request.json
+        data = get_json()
         api_key = data.get('api_key')
         
         if not api_key:
             return jsonify({'valid': False, 'error': 'No API key provided'}), 400
         
+        # Reuse a recent verdict for this key; only its hash is kept in memory
+        key_hash = hashlib.sha256(api_key.encode()).digest()
+        with key_validation_lock:
+            cached = key_validation_cache.get(key_hash)
+        if cached:
+            valid, error_msg = cached
+            if valid:
+                return jsonify({'valid': True})
+            return jsonify({'valid': False, 'error': error_msg}), 400
+        
         # Test the API key with a simple request
-        url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
-        response = requests.post(
-            url,
-            json={
-                'contents': [{
-                    'parts': [{'text': 'test'}]
-                }],
-                'generationConfig': {
-                    'temperature': 0.1,
-                    'maxOutputTokens': 10,
-                }
-            },
-            timeout=10
-        )
+        response = call_gemini(api_key, 'test', temperature=0.1, max_output_tokens=10, read_timeout=5)
         
         print(f"[DEBUG] Test API status: {response.status_code}")
         
         if response.status_code == 200:
+            with key_validation_lock:
+                key_validation_cache[key_hash] = (True, None)
             return jsonify({'valid': True})
         elif response.status_code == 400 or response.status_code == 401:
             try:
@@ -399,6 +770,8 @@ def test_api_key():
                 error_msg = error_data.get('error', {}).get('message', 'Invalid API key')
             except:
                 error_msg = response.text
+            with key_validation_lock:
+                key_validation_cache[key_hash] = (False, error_msg)
             return jsonify({'valid': False, 'error': error_msg}), 400
         else:
             return jsonify({'valid': False, 'error': f'API returned status {response.status_code}'}), 400
@@ -414,39 +787,24 @@ def test_api_key():
 def generate_response():
     """Generate AI response using Gemini API"""
     try:
-        data = request.json
+        data = get_json()
         api_key = data.get('api_key')
         prompt = data.get('prompt')
         conversation_history = data.get('history', [])
+        stream = bool(data.get('stream'))
         
         if not api_key or not prompt:
             return jsonify({'error': 'Missing required fields'}), 400
         
-        # Prepare the request to Gemini API
-        url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
-        
         # Build conversation context
         full_prompt = prompt
         if conversation_history:
             context = '\n'.join([f"{msg['role']}: {msg['content']}" for msg in conversation_history[-5:]])
             full_prompt = f"Previous conversation:\n{context}\n\n{prompt}"
         
-        response = requests.post(
-            url,
-            json={
-                'contents': [{
-                    'parts': [{'text': full_prompt}]
-                }],
-                'generationConfig': {
-                    'temperature': 0.7,
-                    'maxOutputTokens': 2000,
-                }
-            },
-            timeout=30
-        )
+        response = call_gemini(api_key, full_prompt, temperature=0.7, max_output_tokens=2000, read_timeout=30, stream=stream)
         
         print(f"[DEBUG] Generate API status: {response.status_code}")
-        print(f"[DEBUG] Generate API response: {response.text[:500]}")
         
         if response.status_code != 200:
             error_data = response.json() if response.text else {}
@@ -454,6 +812,21 @@ def generate_response():
             print(f"[DEBUG] Error: {error_msg}")
             return jsonify({'error': f'API request failed: {error_msg}', 'details': response.text}), 500
         
+        if stream:
+            # Relay fragments as they arrive instead of buffering the whole reply
+            def generate():
+                try:
+                    for text in iter_gemini_text(response):
+                        yield sse_event({'text': text})
+                    yield sse_event({'success': True}, event='done')
+                except Exception as e:
+                    print(f"[DEBUG] Exception in generate stream: {str(e)}")
+                    yield sse_event({'error': str(e)}, event='error')
+            
+            return Response(stream_with_context(generate()), mimetype='text/event-stream')
+        
+        print(f"[DEBUG] Generate API response: {response.text[:500]}")
+        
         result = response.json()
         ai_response = result['candidates'][0]['content']['parts'][0]['text']
         
@@ -470,21 +843,24 @@ def generate_response():
 def create_session():
     """Create a new interview session"""
     try:
-        data = request.json
-        session_id = f"session_{datetime.now().timestamp()}"
+        data = get_json()
+        ts, created_at = now_stamp()
+        session_id = f"session_{ts}_{secrets.token_hex(4)}"
         
-        sessions[session_id] = {
+        session = {
             'id': session_id,
-            'created_at': datetime.now().isoformat(),
+            'created_at': created_at,
             'interview_type': data.get('interview_type', 'technical'),
             'difficulty': data.get('difficulty', 'medium'),
-            'conversation_history': [],
+            'conversation_history': deque(maxlen=MAX_CONVERSATION_HISTORY),
             'stats': {
                 'questions_asked': 0,
                 'corrections_made': 0,
                 'duration': 0
             }
         }
+        with session_store_lock:
+            sessions[session_id] = session
         
         return jsonify({
             'session_id': session_id,
@@ -494,32 +870,44 @@ def create_session():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def serialize_session(session):
+    """Copy an interview session into a JSON-serializable dict"""
+    return {**session, 'conversation_history': list(session['conversation_history'])}
+
 @app.route('/api/session/<session_id>', methods=['GET'])
 def get_session(session_id):
     """Get session details"""
-    if session_id not in sessions:
+    with session_store_lock:
+        session = sessions.get(session_id)
+    if session is None:
         return jsonify({'error': 'Session not found'}), 404
     
-    return jsonify(sessions[session_id])
+    return jsonify(serialize_session(session))
 
 @app.route('/api/session/<session_id>/update', methods=['POST'])
 def update_session(session_id):
     """Update session data"""
     try:
-        if session_id not in sessions:
+        with session_store_lock:
+            session = sessions.get(session_id)
+        if session is None:
             return jsonify({'error': 'Session not found'}), 404
         
-        data = request.json
+        data = get_json()
         
         if 'conversation_history' in data:
-            sessions[session_id]['conversation_history'].append(data['conversation_history'])
+            history = data['conversation_history']
+            if isinstance(history, list):
+                session['conversation_history'].extend(history)
+            else:
+                session['conversation_history'].append(history)
         
         if 'stats' in data:
-            sessions[session_id]['stats'].update(data['stats'])
+            session['stats'].update(data['stats'])
         
         return jsonify({
             'success': True,
-            'session': sessions[session_id]
+            'session': serialize_session(session)
         })
         
     except Exception as e:
@@ -529,10 +917,11 @@ def update_session(session_id):
 def analyze_response():
     """Analyze user's response and provide corrections"""
     try:
-        data = request.json
+        data = get_json()
         user_response = data.get('response')
         api_key = data.get('api_key')
         context = data.get('context', '')
+        stream = bool(data.get('stream'))
         
         if not user_response or not api_key:
             return jsonify({'error': 'Missing required fields'}), 400
@@ -553,29 +942,37 @@ Please evaluate:
 Provide specific, actionable feedback. If there are errors or areas for improvement, start with "Correction: " followed by the specific issue and how to fix it.
 """
         
-        url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
-        response = requests.post(
-            url,
-            json={
-                'contents': [{
-                    'parts': [{'text': analysis_prompt}]
-                }],
-                'generationConfig': {
-                    'temperature': 0.7,
-                    'maxOutputTokens': 800,
-                }
-            },
-            timeout=30
-        )
+        response = call_gemini(api_key, analysis_prompt, temperature=0.7, max_output_tokens=800, read_timeout=20, stream=stream)
         
         if response.status_code != 200:
+            # A stream=True body is never read here, so hand the connection back explicitly
+            response.close()
             return jsonify({'error': 'Analysis failed'}), 500
         
+        if stream:
+            def generate():
+                # Only the tail of the previous fragment is kept so a marker split
+                # across fragments is still detected without holding the whole reply
+                tail = ''
+                has_corrections = False
+                try:
+                    for text in iter_gemini_text(response):
+                        if not has_corrections:
+                            window = tail + text
+                            has_corrections = bool(_CORRECTION_RE.search(window))
+                            tail = window[-(len(CORRECTION_MARKER) - 1):]
+                        yield sse_event({'text': text})
+                    yield sse_event({'has_corrections': has_corrections, 'success': True}, event='done')
+                except Exception as e:
+                    yield sse_event({'error': str(e)}, event='error')
+            
+            return Response(stream_with_context(generate()), mimetype='text/event-stream')
+        
         result = response.json()
         analysis = result['candidates'][0]['content']['parts'][0]['text']
         
         # Check if there are corrections
-        has_corrections = 'correction:' in analysis.lower()
+        has_corrections = bool(_CORRECTION_RE.search(analysis))
         
         return jsonify({
             'analysis': analysis,
@@ -597,12 +994,22 @@ def health_check():
 
 # ============ TEACHER ENDPOINTS ============
 
+def decode_questions(paper_id, questions_json):
+    """Decode a paper's questions, reusing the parsed list across requests (treat it as read-only)"""
+    with questions_cache_lock:
+        questions = questions_cache.get(paper_id)
+    if questions is None:
+        questions = json_loads(questions_json)
+        with questions_cache_lock:
+            questions_cache[paper_id] = questions
+    return questions
+
 @app.route('/api/teacher/create-assignment', methods=['POST'])
 @require_teacher
 def create_assignment():
     """Teacher creates question paper and assigns to students"""
     try:
-        data = request.json
+        data = get_json()
         student_ids = data.get('student_ids', [])  # List of student IDs or usernames/emails
         title = data.get('title', '')
         description = data.get('description', '')
@@ -615,51 +1022,59 @@ def create_assignment():
             return jsonify({'error': 'Missing students or questions'}), 400
 
         # Resolve provided student identifiers (allow IDs, usernames or emails)
+        # Compare as text, as the TEXT columns did when each identifier was queried on its own
+        idents = [str(i) for i in student_ids]
         conn = get_db()
         cursor = conn.cursor()
+        placeholders = ','.join('?' * len(idents))
+        cursor.execute(f'''
+        SELECT id, username, email FROM users
+        WHERE user_type = 'student'
+          AND (id IN ({placeholders}) OR username IN ({placeholders}) OR email IN ({placeholders}))
+        ''', idents * 3)
+
+        # Direct id matches take precedence over username/email matches
+        ids_by_id = {}
+        ids_by_name = {}
+        for row in cursor.fetchall():
+            ids_by_id[row['id']] = row['id']
+            ids_by_name.setdefault(row['username'], row['id'])
+            ids_by_name.setdefault(row['email'], row['id'])
+
         resolved_student_ids = []
         skipped = []
-        for ident in student_ids:
-            # Try direct id match first
-            cursor.execute('SELECT id, user_type FROM users WHERE id = ?', (ident,))
-            row = cursor.fetchone()
-            if row and row['user_type'] == 'student':
-                resolved_student_ids.append(row['id'])
-                continue
-
-            # Try username or email
-            cursor.execute('SELECT id, user_type FROM users WHERE username = ? OR email = ?', (ident, ident))
-            row = cursor.fetchone()
-            if row and row['user_type'] == 'student':
-                resolved_student_ids.append(row['id'])
-                continue
-
-            skipped.append(str(ident))
+        for ident in idents:
+            student_id = ids_by_id.get(ident) or ids_by_name.get(ident)
+            if student_id:
+                resolved_student_ids.append(student_id)
+            else:
+                skipped.append(ident)
 
         # Create question paper
         paper_id = generate_uuid()
         created_at = datetime.now().isoformat()
+        questions_json = json_dumps(questions)
 
+        cursor.execute('BEGIN')
         cursor.execute('''
         INSERT INTO question_papers (id, teacher_id, title, description, questions, difficulty, created_at, deadline)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (paper_id, request.user_id, title, description, json.dumps(questions), difficulty, created_at, deadline))
+        ''', (paper_id, request.user_id, title, description, questions_json, difficulty, created_at, deadline))
 
         # Create assignments for each resolved student
-        assignment_ids = []
-        for student_id in resolved_student_ids:
-            assignment_id = generate_uuid()
-            assigned_at = datetime.now().isoformat()
-
-            cursor.execute('''
-            INSERT INTO assignments (id, paper_id, student_id, assigned_at, deadline, status)
-            VALUES (?, ?, ?, ?, ?, 'pending')
-            ''', (assignment_id, paper_id, student_id, assigned_at, deadline))
-
-            assignment_ids.append(assignment_id)
+        rows = [(generate_uuid(), paper_id, student_id, created_at, deadline)
+                for student_id in resolved_student_ids]
+        cursor.executemany('''
+        INSERT INTO assignments (id, paper_id, student_id, assigned_at, deadline, status)
+        VALUES (?, ?, ?, ?, ?, 'pending')
+        ''', rows)
+        assignment_ids = [row[0] for row in rows]
 
         conn.commit()
-        conn.close()
+
+        # Students fetch the paper next; warm the cache with exactly what was stored
+        with questions_cache_lock:
+            questions_cache[paper_id] = json_loads(questions_json)
 
         msg = f'Assignment created and assigned to {len(assignment_ids)} students'
         if skipped:
@@ -685,31 +1100,21 @@ def get_teacher_papers():
         conn = get_db()
         cursor = conn.cursor()
         
+        # Papers with their submission stats in one pass
         cursor.execute('''
-        SELECT id, title, description, difficulty, created_at, deadline
-        FROM question_papers
-        WHERE teacher_id = ?
-        ORDER BY created_at DESC
+        SELECT qp.id, qp.title, qp.description, qp.difficulty, qp.created_at, qp.deadline,
+               COUNT(a.id) as total_assigned,
+               COALESCE(SUM(CASE WHEN a.status = 'submitted' THEN 1 ELSE 0 END), 0) as submitted,
+               COALESCE(SUM(CASE WHEN a.status = 'graded' THEN 1 ELSE 0 END), 0) as graded
+        FROM question_papers qp
+        LEFT JOIN assignments a ON a.paper_id = qp.id
+        WHERE qp.teacher_id = ?
+        GROUP BY qp.id
+        ORDER BY qp.created_at DESC
         ''', (request.user_id,))
         
         papers = [dict(row) for row in cursor.fetchall()]
         
-        # Get submission stats for each paper
-        for paper in papers:
-            cursor.execute('''
-            SELECT COUNT(*) as total_assigned, 
-                   SUM(CASE WHEN status = 'submitted' THEN 1 ELSE 0 END) as submitted,
-                   SUM(CASE WHEN status = 'graded' THEN 1 ELSE 0 END) as graded
-            FROM assignments WHERE paper_id = ?
-            ''', (paper['id'],))
-            
-            stats = cursor.fetchone()
-            paper['total_assigned'] = stats['total_assigned'] or 0
-            paper['submitted'] = stats['submitted'] or 0
-            paper['graded'] = stats['graded'] or 0
-        
-        conn.close()
-        
         return jsonify({
             'success': True,
             'papers': papers
@@ -731,7 +1136,6 @@ def get_submissions(paper_id):
         paper = cursor.fetchone()
         
         if not paper or paper['teacher_id'] != request.user_id:
-            conn.close()
             return jsonify({'error': 'Unauthorized'}), 403
         
         # Get submissions
@@ -744,7 +1148,6 @@ def get_submissions(paper_id):
         ''', (paper_id,))
         
         submissions = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -759,7 +1162,7 @@ def get_submissions(paper_id):
 def grade_submission():
     """Grade a student submission"""
     try:
-        data = request.json
+        data = get_json()
         answer_id = data.get('answer_id')
         grade = data.get('grade')
         feedback = data.get('feedback')
@@ -768,35 +1171,26 @@ def grade_submission():
         conn = get_db()
         cursor = conn.cursor()
         
-        # Get the answer and verify access
-        cursor.execute('''
-        SELECT sa.id, sa.paper_id, qp.teacher_id FROM student_answers sa
-        JOIN question_papers qp ON sa.paper_id = qp.id
-        WHERE sa.id = ?
-        ''', (answer_id,))
-        
-        answer = cursor.fetchone()
-        if not answer or answer['teacher_id'] != request.user_id:
-            conn.close()
-            return jsonify({'error': 'Unauthorized'}), 403
-        
-        # Update with grade
+        # Update with grade; the teacher must own the answer's paper
+        cursor.execute('BEGIN')
         cursor.execute('''
         UPDATE student_answers
         SET graded = 1, grade = ?, feedback = ?
-        WHERE id = ?
-        ''', (grade, feedback, answer_id))
+        WHERE id = ? AND paper_id IN (SELECT id FROM question_papers WHERE teacher_id = ?)
+        ''', (grade, feedback, answer_id, request.user_id))
+        
+        if cursor.rowcount == 0:
+            return jsonify({'error': 'Unauthorized'}), 403
         
         # Update assignment status
         cursor.execute('''
         UPDATE assignments SET status = 'graded'
-        WHERE paper_id = ? AND student_id = (
-            SELECT student_id FROM student_answers WHERE id = ?
+        WHERE (paper_id, student_id) = (
+            SELECT paper_id, student_id FROM student_answers WHERE id = ?
         )
-        ''', (answer['paper_id'], answer_id))
+        ''', (answer_id,))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -831,11 +1225,9 @@ def get_assignments():
         assignments = []
         for row in cursor.fetchall():
             assignment = dict(row)
-            assignment['questions'] = json.loads(assignment['questions'])
+            assignment['questions'] = decode_questions(assignment['paper_id'], assignment['questions'])
             assignments.append(assignment)
         
-        conn.close()
-        
         return jsonify({
             'success': True,
             'assignments': assignments
@@ -849,7 +1241,7 @@ def get_assignments():
 def submit_answers():
     """Submit answers for an assignment"""
     try:
-        data = request.json
+        data = get_json()
         assignment_id = data.get('assignment_id')
         answers = data.get('answers', {})  # dict of question_id -> answer
         
@@ -863,19 +1255,19 @@ def submit_answers():
         
         assignment = cursor.fetchone()
         if not assignment:
-            conn.close()
             return jsonify({'error': 'Assignment not found'}), 404
         
         # Create answer submission
         answer_id = generate_uuid()
         submitted_at = datetime.now().isoformat()
         
+        cursor.execute('BEGIN')
         cursor.execute('''
         INSERT INTO student_answers 
         (id, assignment_id, student_id, paper_id, answers, submitted_at, graded)
         VALUES (?, ?, ?, ?, ?, ?, 0)
         ''', (answer_id, assignment_id, request.user_id, assignment['paper_id'], 
-              json.dumps(answers), submitted_at))
+              json_dumps(answers), submitted_at))
         
         # Update assignment status
         cursor.execute('''
@@ -883,7 +1275,6 @@ def submit_answers():
         ''', (assignment_id,))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -912,7 +1303,6 @@ def get_student_submissions():
         ''', (request.user_id,))
         
         submissions = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -930,23 +1320,22 @@ def get_paper_by_assignment(assignment_id):
         conn = get_db()
         cursor = conn.cursor()
 
-        cursor.execute('SELECT paper_id FROM assignments WHERE id = ? AND student_id = ?', (assignment_id, request.user_id))
-        a = cursor.fetchone()
-        if not a:
-            conn.close()
-            return jsonify({'error': 'Assignment not found'}), 404
-
-        paper_id = a['paper_id']
-        cursor.execute('SELECT id, title, description, questions, difficulty, created_at FROM question_papers WHERE id = ?', (paper_id,))
+        cursor.execute('''
+        SELECT qp.id, qp.title, qp.description, qp.questions, qp.difficulty, qp.created_at
+        FROM assignments a
+        LEFT JOIN question_papers qp ON qp.id = a.paper_id
+        WHERE a.id = ? AND a.student_id = ?
+        ''', (assignment_id, request.user_id))
         paper = cursor.fetchone()
-        conn.close()
-
         if not paper:
+            return jsonify({'error': 'Assignment not found'}), 404
+
+        if paper['id'] is None:
             return jsonify({'error': 'Paper not found'}), 404
 
         paper = dict(paper)
         try:
-            paper['questions'] = json.loads(paper['questions'])
+            paper['questions'] = decode_questions(paper['id'], paper['questions'])
         except Exception:
             paper['questions'] = paper.get('questions')
 
@@ -962,26 +1351,24 @@ def download_paper_for_assignment(assignment_id):
     try:
         conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('SELECT paper_id FROM assignments WHERE id = ? AND student_id = ?', (assignment_id, request.user_id))
-        a = cursor.fetchone()
-        if not a:
-            conn.close()
-            return jsonify({'error': 'Assignment not found'}), 404
-
-        paper_id = a['paper_id']
-        cursor.execute('SELECT title, questions FROM question_papers WHERE id = ?', (paper_id,))
+        cursor.execute('''
+        SELECT a.paper_id, qp.id, qp.title, qp.questions
+        FROM assignments a
+        LEFT JOIN question_papers qp ON qp.id = a.paper_id
+        WHERE a.id = ? AND a.student_id = ?
+        ''', (assignment_id, request.user_id))
         paper = cursor.fetchone()
-        conn.close()
-
         if not paper:
+            return jsonify({'error': 'Assignment not found'}), 404
+
+        if paper['id'] is None:
             return jsonify({'error': 'Paper not found'}), 404
 
+        paper_id = paper['paper_id']
         title = paper['title']
         try:
-            questions = json.loads(paper['questions'])
-            text = ''
-            for i, q in enumerate(questions, start=1):
-                text += f"Q{i}. {q.get('text', str(q))}\n\n"
+            questions = decode_questions(paper['id'], paper['questions'])
+            text = ''.join(f"Q{i}. {q.get('text', str(q))}\n\n" for i, q in enumerate(questions, start=1))
         except Exception:
             text = str(paper['questions'])
 
@@ -990,16 +1377,11 @@ def download_paper_for_assignment(assignment_id):
 
         buffer = io.BytesIO()
         doc = SimpleDocTemplate(buffer, pagesize=letter)
-        styles = getSampleStyleSheet()
-        story = []
-        story.append(Paragraph(title, styles['Heading1']))
-        story.append(Spacer(1, 12))
-
-        for line in text.split('\n'):
-            if line.strip() == '':
-                story.append(Spacer(1, 6))
-            else:
-                story.append(Paragraph(line.replace('\n', '<br/>'), styles['BodyText']))
+        story = [Paragraph(title, PDF_STYLES['Heading1']), Spacer(1, 12)]
+        story.extend(
+            Paragraph(line, PDF_STYLES['BodyText']) if line.strip() else Spacer(1, 6)
+            for line in text.split('\n')
+        )
 
         doc.build(story)
         buffer.seek(0)
@@ -1010,6 +1392,70 @@ def download_paper_for_assignment(assignment_id):
         return jsonify({'error': str(e)}), 500
 
 
+# Auto-grading of PDF submissions runs here so the upload request returns without waiting on Gemini
+GRADING_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='grading')
+
+SUBMISSIONS_DIR = os.path.join(os.getcwd(), 'uploads', 'submissions')
+os.makedirs(SUBMISSIONS_DIR, exist_ok=True)
+
+def _grade_submission_async(answer_id, submitted_at, save_path, api_key, paper_id, questions_json):
+    """Extract, grade and record a saved PDF submission (runs on GRADING_EXECUTOR)"""
+    with app.app_context():
+        try:
+            # Extract text from PDF submission
+            try:
+                transcript, err = extract_text_from_pdf(save_path)
+            except Exception:
+                transcript, err = None, 'Failed to extract text'
+
+            # Paper questions provide context
+            questions = []
+            try:
+                if questions_json:
+                    questions = decode_questions(paper_id, questions_json)
+            except Exception:
+                questions = []
+
+            # Build grading prompt
+            q_text = ''.join(
+                f"Question {i}: {q.get('text') if isinstance(q, dict) else str(q)}\n"
+                for i, q in enumerate(questions, start=1)
+            )
+
+            student_text = transcript or 'Student submission text could not be extracted from PDF.'
+
+            grade_prompt = f"""You are an expert teacher. Grade the student's submission based on the questions below.
+
+QUESTIONS:\n{q_text}\nSTUDENT_SUBMISSION:\n{student_text[:8000]}\n\nFor each question, provide a SCORE out of 10 and constructive FEEDBACK. Then provide an overall SCORE summary line in the format:
+OVERALL_SCORE: [X/10]
+Provide results in plain text with the OVERALL_SCORE line included."""
+
+            # No request thread is waiting on this call, so a slow reply is worth waiting for
+            resp = call_gemini(api_key, grade_prompt, temperature=0.3, max_output_tokens=1600, read_timeout=90)
+            if resp.status_code != 200:
+                print(f"[DEBUG] Auto-grading failed: Gemini status {resp.status_code}")
+                return
+
+            res = resp.json()
+            grading_text = res['candidates'][0]['content']['parts'][0]['text']
+            overall = parse_score(grading_text)
+
+            conn = get_db()
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            # Matching submitted_at drops the result if the student re-uploaded while this job ran
+            cursor.execute('''
+            UPDATE student_answers SET graded = 1, grade = ?, feedback = ?
+            WHERE id = ? AND submitted_at = ?
+            RETURNING assignment_id
+            ''', (overall, grading_text, answer_id, submitted_at))
+            graded = cursor.fetchall()
+            if graded:
+                cursor.execute('UPDATE assignments SET status = ? WHERE id = ?', ('graded', graded[0]['assignment_id']))
+            conn.commit()
+        except Exception as e:
+            print(f"[DEBUG] Auto-grading failed: {str(e)}")
+
 @app.route('/api/student/submit-pdf', methods=['POST'])
 @require_student
 def submit_pdf():
@@ -1026,33 +1472,54 @@ def submit_pdf():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
 
+        # Assignment and its paper's questions in one lookup
         conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('SELECT paper_id, status FROM assignments WHERE id = ? AND student_id = ?', (assignment_id, request.user_id))
+        cursor.execute('''
+        SELECT a.paper_id, qp.questions
+        FROM assignments a
+        LEFT JOIN question_papers qp ON qp.id = a.paper_id
+        WHERE a.id = ? AND a.student_id = ?
+        ''', (assignment_id, request.user_id))
         a = cursor.fetchone()
         if not a:
-            conn.close()
             return jsonify({'error': 'Assignment not found'}), 404
 
-        # Save file to uploads directory
-        upload_dir = os.path.join(os.getcwd(), 'uploads', 'submissions')
-        os.makedirs(upload_dir, exist_ok=True)
-        safe_name = f"{assignment_id}_{int(datetime.now().timestamp())}_{file.filename}"
-        save_path = os.path.join(upload_dir, safe_name)
-        file.save(save_path)
+        # Save file to uploads directory; the client's filename is sanitised and the
+        # upload lands under a temp name first so a crash never leaves a torn PDF behind
+        ts, submitted_at = now_stamp()
+        safe_name = secure_filename(f"{assignment_id}_{int(ts)}_{file.filename}")
+        if not safe_name.lower().endswith('.pdf'):
+            safe_name += '.pdf'
+        save_path = os.path.join(SUBMISSIONS_DIR, safe_name)
+        tmp = tempfile.NamedTemporaryFile(dir=SUBMISSIONS_DIR, suffix='.part', delete=False)
+        try:
+            with tmp:
+                file.save(tmp)
+            os.replace(tmp.name, save_path)
+        except Exception:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+            raise
+
+        # Record the submission; grading (if an api_key was given) happens in the background
+        answers_payload = json_dumps({'file_path': save_path})
 
-        # Check if a submission already exists for this assignment
-        cursor.execute('SELECT id FROM student_answers WHERE assignment_id = ? AND student_id = ?', (assignment_id, request.user_id))
-        existing = cursor.fetchone()
-        submitted_at = datetime.now().isoformat()
-        answers_payload = json.dumps({'file_path': save_path})
+        cursor.execute('BEGIN IMMEDIATE')
+        # Resubmissions overwrite one existing answer; an earlier grade is kept until regraded.
+        # submit_answers adds a row per submission, so only a single row may be touched here.
+        cursor.execute('''
+        UPDATE student_answers
+        SET answers = ?, submitted_at = ?, graded = 0
+        WHERE id = (
+            SELECT id FROM student_answers WHERE assignment_id = ? AND student_id = ? LIMIT 1
+        )
+        RETURNING id
+        ''', (answers_payload, submitted_at, assignment_id, request.user_id))
+        existing = cursor.fetchall()
 
         if existing:
-            # Update existing submission
-            answer_id = existing['id']
-            cursor.execute('''
-            UPDATE student_answers SET answers = ?, submitted_at = ?, graded = 0 WHERE id = ?
-            ''', (answers_payload, submitted_at, answer_id))
+            answer_id = existing[0]['id']
         else:
             answer_id = generate_uuid()
             cursor.execute('''
@@ -1061,85 +1528,20 @@ def submit_pdf():
             ''', (answer_id, assignment_id, request.user_id, a['paper_id'], answers_payload, submitted_at))
 
         # Update assignment status
-        cursor.execute('UPDATE assignments SET status = "submitted" WHERE id = ?', (assignment_id,))
-        # Attempt auto-grading if api_key provided
-        api_key = request.form.get('api_key')
-        grading_info = None
-        try:
-            if api_key:
-                # Extract text from PDF submission
-                try:
-                    with open(save_path, 'rb') as f:
-                        pdf_bytes = f.read()
-                    transcript, err = extract_text_from_pdf(io.BytesIO(pdf_bytes))
-                except Exception:
-                    transcript, err = None, 'Failed to extract text'
-
-                # Get paper questions to provide context
-                cursor.execute('SELECT questions FROM question_papers WHERE id = ?', (a['paper_id'],))
-                qp = cursor.fetchone()
-                questions = []
-                try:
-                    if qp and qp['questions']:
-                        questions = json.loads(qp['questions'])
-                except Exception:
-                    questions = []
-
-                # Build grading prompt
-                q_text = ''
-                for i, q in enumerate(questions, start=1):
-                    qbody = q.get('text') if isinstance(q, dict) else str(q)
-                    q_text += f"Question {i}: {qbody}\n"
-
-                student_text = transcript or 'Student submission text could not be extracted from PDF.'
-
-                grade_prompt = f"""You are an expert teacher. Grade the student's submission based on the questions below.
-
-QUESTIONS:\n{q_text}\nSTUDENT_SUBMISSION:\n{student_text[:8000]}\n\nFor each question, provide a SCORE out of 10 and constructive FEEDBACK. Then provide an overall SCORE summary line in the format:
-OVERALL_SCORE: [X/10]
-Provide results in plain text with the OVERALL_SCORE line included."""
-
-                url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
-                resp = requests.post(
-                    url,
-                    json={
-                        'contents': [{ 'parts': [{'text': grade_prompt}] }],
-                        'generationConfig': {'temperature': 0.3, 'maxOutputTokens': 1600}
-                    },
-                    timeout=30
-                )
-
-                if resp.status_code == 200:
-                    res = resp.json()
-                    grading_text = res['candidates'][0]['content']['parts'][0]['text']
-                    # Parse overall score if present
-                    overall = 'N/A'
-                    try:
-                        if 'OVERALL_SCORE:' in grading_text:
-                            overall = grading_text.split('OVERALL_SCORE:')[1].split('\n')[0].strip()
-                        elif 'SCORE:' in grading_text:
-                            overall = grading_text.split('SCORE:')[1].split('\n')[0].strip()
-                    except Exception:
-                        overall = 'N/A'
-
-                    # Update submission with grading
-                    cursor.execute('''
-                    UPDATE student_answers SET graded = 1, grade = ?, feedback = ? WHERE id = ?
-                    ''', (overall, grading_text, answer_id))
-                    cursor.execute('UPDATE assignments SET status = "graded" WHERE id = ?', (assignment_id,))
-                    conn.commit()
-                    grading_info = {'grade': overall, 'feedback': grading_text}
-        except Exception as e:
-            print(f"[DEBUG] Auto-grading failed: {str(e)}")
-
+        cursor.execute('UPDATE assignments SET status = ? WHERE id = ?', ('submitted', assignment_id))
         conn.commit()
-        conn.close()
 
-        resp_payload = {'success': True, 'answer_id': answer_id, 'message': 'PDF submitted successfully'}
-        if grading_info:
-            resp_payload['grading'] = grading_info
+        api_key = request.form.get('api_key')
+        if not api_key:
+            return jsonify({'success': True, 'answer_id': answer_id, 'message': 'PDF submitted successfully'}), 201
 
-        return jsonify(resp_payload), 201
+        GRADING_EXECUTOR.submit(_grade_submission_async, answer_id, submitted_at, save_path, api_key, a['paper_id'], a['questions'])
+        return jsonify({
+            'success': True,
+            'answer_id': answer_id,
+            'message': 'PDF submitted successfully; grading in progress',
+            'grading_status': 'pending'
+        }), 202
     except Exception as e:
         print(f"[DEBUG] submit_pdf error: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -1152,21 +1554,20 @@ def get_submission_details(submission_id):
         cursor = conn.cursor()
         
         cursor.execute('''
-        SELECT sa.id, sa.answers, sa.grade, sa.feedback, qp.questions, qp.title
+        SELECT sa.id, sa.paper_id, sa.answers, sa.grade, sa.feedback, qp.questions, qp.title
         FROM student_answers sa
         JOIN question_papers qp ON sa.paper_id = qp.id
         WHERE sa.id = ? AND sa.student_id = ?
         ''', (submission_id, request.user_id))
         
         submission = cursor.fetchone()
-        conn.close()
         
         if not submission:
             return jsonify({'error': 'Submission not found'}), 404
         
         submission = dict(submission)
-        submission['answers'] = json.loads(submission['answers'])
-        submission['questions'] = json.loads(submission['questions'])
+        submission['answers'] = json_loads(submission['answers'])
+        submission['questions'] = decode_questions(submission['paper_id'], submission['questions'])
         
         return jsonify({
             'success': True,
@@ -1178,56 +1579,91 @@ def get_submission_details(submission_id):
 
 # ============ TEACHER MODE ENDPOINTS ============
 
+# PDFium is not thread-safe: every call into it, from open to close, must hold this lock
+_pdfium_lock = threading.Lock()
+
 def extract_text_from_pdf(pdf_file):
-    """Extract text from PDF file"""
+    """Extract text from a PDF given as a file path or file-like object"""
     try:
+        # PDFium (C++) is much faster than PyPDF2 on page-heavy documents
+        if HAS_PDFIUM:
+            with _pdfium_lock:
+                pdf = pdfium.PdfDocument(pdf_file)
+                try:
+                    pages = []
+                    for page in pdf:
+                        textpage = page.get_textpage()
+                        pages.append(textpage.get_text_range())
+                        textpage.close()
+                        page.close()
+                    return "\n".join(pages), None
+                finally:
+                    pdf.close()
+
         if not HAS_PDF:
-            return None, "PyPDF2 not installed"
+            return None, "No PDF library installed (pypdfium2 or PyPDF2)"
         
         pdf_reader = PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text, None
+        return "".join((page.extract_text() or "") + "\n" for page in pdf_reader.pages), None
     except Exception as e:
         return None, str(e)
 
+def teacher_session_cutoff():
+    """Oldest created_at still inside SESSIONS_TIMEOUT; older teacher sessions are expired"""
+    return (datetime.now() - timedelta(hours=SESSIONS_TIMEOUT)).isoformat()
+
+def purge_expired_teacher_sessions(cursor, cutoff):
+    """Delete teacher sessions older than cutoff along with their papers, messages and grades"""
+    for table in ('teacher_messages', 'teacher_papers', 'teacher_graded_answers'):
+        cursor.execute(f'''
+        DELETE FROM {table}
+        WHERE session_id IN (SELECT id FROM teacher_sessions WHERE created_at <= ?)
+        ''', (cutoff,))
+    cursor.execute('DELETE FROM teacher_sessions WHERE created_at <= ?', (cutoff,))
+
+def pack_context(syllabus, pyq, budget=CONTEXT_TOKEN_BUDGET):
+    """Trim syllabus and PYQ text to share an approximate token budget
+    
+    Each side gets half; whatever one doesn't need is given to the other.
+    """
+    limit = budget * CHARS_PER_TOKEN
+    syllabus_limit = max(limit // 2, limit - len(pyq))
+    pyq_limit = limit - min(len(syllabus), syllabus_limit)
+    return syllabus[:syllabus_limit], pyq[:pyq_limit]
+
 @app.route('/api/teacher/session/create', methods=['POST'])
 def create_teacher_session():
     """Create a new teacher session with uploaded PDFs"""
     try:
-        session_id = f"teacher_{datetime.now().timestamp()}"
+        ts, created_at = now_stamp()
+        session_id = f"teacher_{ts}_{secrets.token_hex(4)}"
         
-        # Handle file uploads
+        # Handle file uploads; parsed straight from the upload stream rather than a copy
         syllabus_text = ""
         pyq_text = ""
         
         if 'syllabus' in request.files:
             syllabus_file = request.files['syllabus']
-            text, error = extract_text_from_pdf(io.BytesIO(syllabus_file.read()))
+            text, error = extract_text_from_pdf(syllabus_file.stream)
             if text:
                 syllabus_text = text
         
         if 'pyq' in request.files:
             pyq_file = request.files['pyq']
-            text, error = extract_text_from_pdf(io.BytesIO(pyq_file.read()))
+            text, error = extract_text_from_pdf(pyq_file.stream)
             if text:
                 pyq_text = text
         
-        teacher_sessions[session_id] = {
-            'id': session_id,
-            'created_at': datetime.now().isoformat(),
-            'syllabus': syllabus_text,
-            'pyq': pyq_text,
-            'conversation_history': [],
-            'generated_papers': [],
-            'graded_answers': [],
-            'stats': {
-                'questions_asked': 0,
-                'papers_generated': 0,
-                'answers_graded': 0
-            }
-        }
+        # Stored in sqlite so every worker process sees the session and it survives restarts
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        purge_expired_teacher_sessions(cursor, teacher_session_cutoff())
+        cursor.execute('''
+        INSERT INTO teacher_sessions (id, syllabus, pyq, created_at)
+        VALUES (?, ?, ?, ?)
+        ''', (session_id, syllabus_text, pyq_text, created_at))
+        conn.commit()
         
         return jsonify({
             'session_id': session_id,
@@ -1243,22 +1679,35 @@ def create_teacher_session():
 def teach_mode():
     """Interactive teaching mode - answer questions about content"""
     try:
-        data = request.json
+        data = get_json()
         session_id = data.get('session_id')
         user_question = data.get('question')
         api_key = data.get('api_key')
         
-        if session_id not in teacher_sessions:
+        if not user_question or not api_key:
+            return jsonify({'error': 'Missing required fields'}), 400
+        
+        conn = get_db()
+        cursor = conn.cursor()
+        # Neither side can use more than the whole budget, so don't load past it
+        cursor.execute('''
+        SELECT substr(syllabus, 1, ?) AS syllabus, substr(pyq, 1, ?) AS pyq
+        FROM teacher_sessions
+        WHERE id = ? AND created_at > ?
+        ''', (CONTEXT_TOKEN_BUDGET * CHARS_PER_TOKEN, CONTEXT_TOKEN_BUDGET * CHARS_PER_TOKEN,
+              session_id, teacher_session_cutoff()))
+        session = cursor.fetchone()
+        if session is None:
             return jsonify({'error': 'Session not found'}), 404
         
-        session = teacher_sessions[session_id]
-        content = f"Syllabus:\n{session['syllabus']}\n\nPrevious Year Questions:\n{session['pyq']}"
+        syllabus, pyq = pack_context(session['syllabus'], session['pyq'])
+        content = f"Syllabus:\n{syllabus}\n\nPrevious Year Questions:\n{pyq}"
         
         # Create teaching prompt
         teach_prompt = f"""You are an expert teacher. Based on the following educational content, answer the student's question clearly and comprehensively.
 
 EDUCATIONAL CONTENT:
-{content[:5000]}  # Limit context to avoid token limits
+{content}
 
 STUDENT QUESTION: {user_question}
 
@@ -1268,20 +1717,7 @@ Provide a clear, educational response that:
 3. Explains concepts in simple terms
 4. Suggests related topics to explore"""
         
-        url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
-        response = requests.post(
-            url,
-            json={
-                'contents': [{
-                    'parts': [{'text': teach_prompt}]
-                }],
-                'generationConfig': {
-                    'temperature': 0.7,
-                    'maxOutputTokens': 2000,
-                }
-            },
-            timeout=30
-        )
+        response = call_gemini(api_key, teach_prompt, temperature=0.7, max_output_tokens=2000, read_timeout=30)
         
         if response.status_code != 200:
             return jsonify({'error': 'Failed to generate response'}), 500
@@ -1290,15 +1726,14 @@ Provide a clear, educational response that:
         ai_response = result['candidates'][0]['content']['parts'][0]['text']
         
         # Store in conversation history
-        session['conversation_history'].append({
-            'role': 'student',
-            'content': user_question
-        })
-        session['conversation_history'].append({
-            'role': 'teacher',
-            'content': ai_response
-        })
-        session['stats']['questions_asked'] += 1
+        now = datetime.now().isoformat()
+        cursor.execute('BEGIN')
+        cursor.execute('UPDATE teacher_sessions SET questions_asked = questions_asked + 1 WHERE id = ?', (session_id,))
+        cursor.executemany('''
+        INSERT INTO teacher_messages (session_id, role, content, created_at)
+        VALUES (?, ?, ?, ?)
+        ''', [(session_id, 'student', user_question, now), (session_id, 'teacher', ai_response, now)])
+        conn.commit()
         
         return jsonify({
             'response': ai_response,
@@ -1313,24 +1748,34 @@ Provide a clear, educational response that:
 def generate_question_paper():
     """Generate a question paper based on syllabus and PYQs"""
     try:
-        data = request.json
+        data = get_json()
         session_id = data.get('session_id')
         num_questions = data.get('num_questions', 10)
         difficulty = data.get('difficulty', 'medium')
         api_key = data.get('api_key')
         question_types = data.get('question_types', ['short', 'long', 'multiple'])
         
-        if session_id not in teacher_sessions:
+        conn = get_db()
+        cursor = conn.cursor()
+        # Neither side can use more than the whole budget, so don't load past it
+        cursor.execute('''
+        SELECT substr(syllabus, 1, ?) AS syllabus, substr(pyq, 1, ?) AS pyq
+        FROM teacher_sessions
+        WHERE id = ? AND created_at > ?
+        ''', (CONTEXT_TOKEN_BUDGET * CHARS_PER_TOKEN, CONTEXT_TOKEN_BUDGET * CHARS_PER_TOKEN,
+              session_id, teacher_session_cutoff()))
+        session = cursor.fetchone()
+        if session is None:
             return jsonify({'error': 'Session not found'}), 404
         
-        session = teacher_sessions[session_id]
-        content = f"Syllabus:\n{session['syllabus']}\n\nPrevious Year Questions:\n{session['pyq']}"
+        syllabus, pyq = pack_context(session['syllabus'], session['pyq'])
+        content = f"Syllabus:\n{syllabus}\n\nPrevious Year Questions:\n{pyq}"
         
         # Create paper generation prompt
         paper_prompt = f"""You are an expert question paper creator. Based on the provided educational content, create {num_questions} questions of {difficulty} difficulty level.
 
 EDUCATIONAL CONTENT:
-{content[:5000]}
+{content}
 
 REQUIREMENTS:
 - Create {num_questions} questions
@@ -1351,20 +1796,7 @@ FORMAT YOUR RESPONSE AS:
 ... etc
 ===END PAPER==="""
         
-        url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
-        response = requests.post(
-            url,
-            json={
-                'contents': [{
-                    'parts': [{'text': paper_prompt}]
-                }],
-                'generationConfig': {
-                    'temperature': 0.8,
-                    'maxOutputTokens': 3000,
-                }
-            },
-            timeout=30
-        )
+        response = call_gemini(api_key, paper_prompt, temperature=0.8, max_output_tokens=3000, read_timeout=45)
         
         if response.status_code != 200:
             return jsonify({'error': 'Failed to generate paper'}), 500
@@ -1372,15 +1804,15 @@ FORMAT YOUR RESPONSE AS:
         result = response.json()
         paper_content = result['candidates'][0]['content']['parts'][0]['text']
         
-        paper_id = f"paper_{datetime.now().timestamp()}"
-        session['generated_papers'].append({
-            'id': paper_id,
-            'created_at': datetime.now().isoformat(),
-            'content': paper_content,
-            'num_questions': num_questions,
-            'difficulty': difficulty
-        })
-        session['stats']['papers_generated'] += 1
+        ts, created_at = now_stamp()
+        paper_id = f"paper_{ts}_{secrets.token_hex(4)}"
+        cursor.execute('BEGIN')
+        cursor.execute('''
+        INSERT INTO teacher_papers (id, session_id, content, num_questions, difficulty, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (paper_id, session_id, paper_content, num_questions, difficulty, created_at))
+        cursor.execute('UPDATE teacher_sessions SET papers_generated = papers_generated + 1 WHERE id = ?', (session_id,))
+        conn.commit()
         
         return jsonify({
             'paper_id': paper_id,
@@ -1392,25 +1824,9 @@ FORMAT YOUR RESPONSE AS:
         print(f"[DEBUG] Error generating paper: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/teacher/grade-answer', methods=['POST'])
-def grade_answer():
-    """Grade a student's answer"""
-    try:
-        data = request.json
-        session_id = data.get('session_id')
-        student_name = data.get('student_name', 'Anonymous')
-        question = data.get('question')
-        answer = data.get('answer')
-        api_key = data.get('api_key')
-        expected_answer = data.get('expected_answer', '')
-        
-        if session_id not in teacher_sessions:
-            return jsonify({'error': 'Session not found'}), 404
-        
-        session = teacher_sessions[session_id]
-        
-        # Create grading prompt
-        grade_prompt = f"""You are an expert teacher grading a student's answer. Evaluate the following response and provide detailed feedback.
+def build_grade_prompt(question, answer, expected_answer=''):
+    """Build the Gemini prompt used to grade a single answer"""
+    return f"""You are an expert teacher grading a student's answer. Evaluate the following response and provide detailed feedback.
 
 QUESTION: {question}
 
@@ -1430,21 +1846,35 @@ FEEDBACK: [Detailed constructive feedback]
 STRENGTHS: [What was good about this answer]
 IMPROVEMENTS: [What could be better]
 CORRECT_ANSWER: [Brief correct answer if needed]"""
+
+def parse_score(grading):
+    """Pull the OVERALL_SCORE line, or failing that the first SCORE line, out of a grading reply"""
+    match = _OVERALL_SCORE_RE.search(grading) or _SCORE_RE.search(grading)
+    return match.group(1).strip() if match else "N/A"
+
+@app.route('/api/teacher/grade-answer', methods=['POST'])
+def grade_answer():
+    """Grade a student's answer"""
+    try:
+        data = get_json()
+        session_id = data.get('session_id')
+        student_name = data.get('student_name', 'Anonymous')
+        question = data.get('question')
+        answer = data.get('answer')
+        api_key = data.get('api_key')
+        expected_answer = data.get('expected_answer', '')
         
-        url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
-        response = requests.post(
-            url,
-            json={
-                'contents': [{
-                    'parts': [{'text': grade_prompt}]
-                }],
-                'generationConfig': {
-                    'temperature': 0.5,
-                    'maxOutputTokens': 1500,
-                }
-            },
-            timeout=30
-        )
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT 1 FROM teacher_sessions WHERE id = ? AND created_at > ?
+        ''', (session_id, teacher_session_cutoff()))
+        if cursor.fetchone() is None:
+            return jsonify({'error': 'Session not found'}), 404
+        
+        grade_prompt = build_grade_prompt(question, answer, expected_answer)
+
+        response = call_gemini(api_key, grade_prompt, temperature=0.5, max_output_tokens=1500, read_timeout=30)
         
         if response.status_code != 200:
             return jsonify({'error': 'Failed to grade answer'}), 500
@@ -1452,23 +1882,17 @@ CORRECT_ANSWER: [Brief correct answer if needed]"""
         result = response.json()
         grading = result['candidates'][0]['content']['parts'][0]['text']
         
-        # Parse score from grading
-        score = "N/A"
-        if "SCORE:" in grading:
-            score_text = grading.split("SCORE:")[1].split("\n")[0].strip()
-            score = score_text
-        
-        grade_id = f"grade_{datetime.now().timestamp()}"
-        session['graded_answers'].append({
-            'id': grade_id,
-            'student_name': student_name,
-            'question': question,
-            'answer': answer,
-            'grading': grading,
-            'score': score,
-            'created_at': datetime.now().isoformat()
-        })
-        session['stats']['answers_graded'] += 1
+        score = parse_score(grading)
+        
+        ts, created_at = now_stamp()
+        grade_id = f"grade_{ts}_{secrets.token_hex(4)}"
+        cursor.execute('BEGIN')
+        cursor.execute('''
+        INSERT INTO teacher_graded_answers (id, session_id, student_name, question, answer, grading, score, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (grade_id, session_id, student_name, question, answer, grading, score, created_at))
+        cursor.execute('UPDATE teacher_sessions SET answers_graded = answers_graded + 1 WHERE id = ?', (session_id,))
+        conn.commit()
         
         return jsonify({
             'grade_id': grade_id,
@@ -1481,20 +1905,121 @@ CORRECT_ANSWER: [Brief correct answer if needed]"""
         print(f"[DEBUG] Error grading answer: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+GRADE_BATCH_MAX = 50
+# Caps batch-grading calls in flight across all requests so one large batch can't
+# monopolise GEMINI_EXECUTOR or burst past the provider's rate limit
+GRADE_BATCH_SLOTS = threading.BoundedSemaphore(10)
+
+@app.route('/api/teacher/grade-batch', methods=['POST'])
+def grade_batch():
+    """Grade several answers concurrently"""
+    try:
+        data = get_json()
+        session_id = data.get('session_id')
+        student_name = data.get('student_name', 'Anonymous')
+        api_key = data.get('api_key')
+        answers = data.get('answers')
+
+        if not isinstance(answers, list) or not answers or not all(isinstance(a, dict) for a in answers):
+            return jsonify({'error': 'answers must be a non-empty list of objects'}), 400
+        if len(answers) > GRADE_BATCH_MAX:
+            return jsonify({'error': f'At most {GRADE_BATCH_MAX} answers per batch'}), 400
+
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT 1 FROM teacher_sessions WHERE id = ? AND created_at > ?
+        ''', (session_id, teacher_session_cutoff()))
+        if cursor.fetchone() is None:
+            return jsonify({'error': 'Session not found'}), 404
+
+        # Fan the prompts out; each call holds a slot until its response arrives
+        futures = []
+        for item in answers:
+            GRADE_BATCH_SLOTS.acquire()
+            try:
+                future = submit_gemini(
+                    api_key,
+                    build_grade_prompt(item.get('question'), item.get('answer'), item.get('expected_answer', '')),
+                    temperature=0.5,
+                    max_output_tokens=1500,
+                    read_timeout=30
+                )
+            except Exception:
+                GRADE_BATCH_SLOTS.release()
+                raise
+            future.add_done_callback(lambda _: GRADE_BATCH_SLOTS.release())
+            futures.append(future)
+
+        results = []
+        graded_answers = []
+        ts, created_at = now_stamp()
+        for i, (item, future) in enumerate(zip(answers, futures)):
+            try:
+                response = future.result()
+                if response.status_code != 200:
+                    results.append({'index': i, 'success': False, 'error': 'Failed to grade answer'})
+                    continue
+                # A 200 can still lack parts (safety block, MAX_TOKENS); that fails this item only
+                grading = response.json()['candidates'][0]['content']['parts'][0]['text']
+            except Exception as e:
+                results.append({'index': i, 'success': False, 'error': str(e)})
+                continue
+            score = parse_score(grading)
+            grade_id = f"grade_{ts}_{i}_{secrets.token_hex(4)}"
+            graded_answers.append((
+                grade_id, session_id, item.get('student_name', student_name), item.get('question'),
+                item.get('answer'), grading, score, created_at
+            ))
+            results.append({'index': i, 'success': True, 'grade_id': grade_id, 'grading': grading, 'score': score})
+
+        # Record the whole batch in one transaction
+        cursor.execute('BEGIN')
+        cursor.executemany('''
+        INSERT INTO teacher_graded_answers (id, session_id, student_name, question, answer, grading, score, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', graded_answers)
+        cursor.execute('UPDATE teacher_sessions SET answers_graded = answers_graded + ? WHERE id = ?',
+                      (len(graded_answers), session_id))
+        conn.commit()
+
+        print(f"[DEBUG] Batch graded {len(graded_answers)}/{len(answers)} answers")
+        return jsonify({
+            'results': results,
+            'graded': len(graded_answers),
+            'failed': len(answers) - len(graded_answers),
+            'success': True
+        })
+
+    except Exception as e:
+        print(f"[DEBUG] Error grading batch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/teacher/session/<session_id>', methods=['GET'])
 def get_teacher_session(session_id):
     """Get teacher session details"""
-    if session_id not in teacher_sessions:
+    # Don't load or return full content to save bandwidth
+    cursor = get_db().cursor()
+    cursor.execute('''
+    SELECT id, created_at, length(syllabus) > 0 AS has_syllabus, length(pyq) > 0 AS has_pyq,
+           questions_asked, papers_generated, answers_graded
+    FROM teacher_sessions
+    WHERE id = ? AND created_at > ?
+    ''', (session_id, teacher_session_cutoff()))
+    session = cursor.fetchone()
+    if session is None:
         return jsonify({'error': 'Session not found'}), 404
     
-    session = teacher_sessions[session_id]
-    # Don't return full content to save bandwidth
     return jsonify({
         'id': session['id'],
         'created_at': session['created_at'],
-        'has_syllabus': len(session['syllabus']) > 0,
-        'has_pyq': len(session['pyq']) > 0,
-        'stats': session['stats']
+        'has_syllabus': bool(session['has_syllabus']),
+        'has_pyq': bool(session['has_pyq']),
+        'stats': {
+            'questions_asked': session['questions_asked'],
+            'papers_generated': session['papers_generated'],
+            'answers_graded': session['answers_graded']
+        }
     })
 
 @app.route('/api/teacher/download-paper/<paper_id>', methods=['GET'])
@@ -1502,43 +2027,38 @@ def download_question_paper(paper_id):
     """Download generated question paper as PDF"""
     try:
         # Find the paper
-        for session_id, session in teacher_sessions.items():
-            for paper in session['generated_papers']:
-                if paper['id'] == paper_id:
-                    if not HAS_REPORTLAB:
-                        return jsonify({'error': 'PDF generation not available'}), 500
-                    
-                    # Create PDF
-                    buffer = io.BytesIO()
-                    doc = SimpleDocTemplate(buffer, pagesize=letter)
-                    styles = getSampleStyleSheet()
-                    story = []
-                    
-                    # Add title
-                    title_style = ParagraphStyle(
-                        'CustomTitle',
-                        parent=styles['Heading1'],
-                        fontSize=24,
-                        textColor='#000000',
-                        spaceAfter=30,
-                        alignment=1
-                    )
-                    story.append(Paragraph("QUESTION PAPER", title_style))
-                    story.append(Spacer(1, 0.2*inch))
-                    
-                    # Add content
-                    story.append(Paragraph(paper['content'].replace("\n", "<br/>"), styles['Normal']))
-                    
-                    # Build PDF
-                    doc.build(story)
-                    buffer.seek(0)
-                    
-                    return buffer.getvalue(), 200, {
-                        'Content-Type': 'application/pdf',
-                        'Content-Disposition': f'attachment; filename="question_paper_{paper_id}.pdf"'
-                    }
-        
-        return jsonify({'error': 'Paper not found'}), 404
+        cursor = get_db().cursor()
+        cursor.execute('''
+        SELECT tp.content
+        FROM teacher_papers tp
+        JOIN teacher_sessions ts ON ts.id = tp.session_id
+        WHERE tp.id = ? AND ts.created_at > ?
+        ''', (paper_id, teacher_session_cutoff()))
+        paper = cursor.fetchone()
+        if paper is None:
+            return jsonify({'error': 'Paper not found'}), 404
+        
+        if not HAS_REPORTLAB:
+            return jsonify({'error': 'PDF generation not available'}), 500
+        
+        # Create PDF
+        buffer = io.BytesIO()
+        doc = SimpleDocTemplate(buffer, pagesize=letter)
+        story = []
+        
+        # Add title
+        story.append(Paragraph("QUESTION PAPER", PDF_TITLE_STYLE))
+        story.append(Spacer(1, 0.2*inch))
+        
+        # Add content
+        story.append(Paragraph(paper['content'].replace("\n", "<br/>"), PDF_STYLES['Normal']))
+        
+        # Build PDF; send_file streams the buffer instead of copying it out with getvalue()
+        doc.build(story)
+        buffer.seek(0)
+        
+        return send_file(buffer, as_attachment=True, download_name=f"question_paper_{paper_id}.pdf",
+                         mimetype='application/pdf')
         
     except Exception as e:
         print(f"[DEBUG] Error downloading paper: {str(e)}")
@@ -1548,7 +2068,7 @@ def download_question_paper(paper_id):
 def analyze_tone():
     """Analyze tone and emotion of user's speech using Gemini"""
     try:
-        data = request.json
+        data = get_json()
         transcript = data.get('transcript', '')
         api_key = data.get('api_key')
         
@@ -1576,20 +2096,7 @@ Respond in JSON format:
     "feedback": "brief feedback about their delivery"
 }}"""
         
-        url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}'
-        response = requests.post(
-            url,
-            json={
-                'contents': [{
-                    'parts': [{'text': tone_prompt}]
-                }],
-                'generationConfig': {
-                    'temperature': 0.3,
-                    'maxOutputTokens': 1000,
-                }
-            },
-            timeout=10
-        )
+        response = call_gemini(api_key, tone_prompt, temperature=0.3, max_output_tokens=1000, read_timeout=5)
         
         if response.status_code != 200:
             print(f"[DEBUG] Tone analysis failed: {response.text}")
@@ -1614,7 +2121,7 @@ Respond in JSON format:
             json_end = ai_response.rfind('}') + 1
             if json_start >= 0 and json_end > json_start:
                 json_str = ai_response[json_start:json_end]
-                tone_data = json.loads(json_str)
+                tone_data = json_loads(json_str)
             else:
                 tone_data = {
                     'confidence': 'medium',
@@ -1660,7 +2167,7 @@ Respond in JSON format:
 def create_learning_session():
     """Create interactive learning session"""
     try:
-        data = request.json
+        data = get_json()
         topic = data.get('topic', '')
         content = data.get('content', '')
         user_id = data.get('user_id', '')
@@ -1674,10 +2181,9 @@ def create_learning_session():
         cursor.execute('''
         INSERT INTO learning_sessions (id, student_id, topic, content, audio_recordings, created_at)
         VALUES (?, ?, ?, ?, ?, ?)
-        ''', (session_id, user_id, topic, content, json.dumps([]), created_at))
+        ''', (session_id, user_id, topic, content, json_dumps([]), created_at))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'session_id': session_id,
@@ -1687,39 +2193,42 @@ def create_learning_session():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def base64_decoded_size(blob):
+    """Byte size of a base64 string or data URL's payload, without decoding it"""
+    payload = blob.partition(',')[2] if blob.startswith('data:') else blob
+    payload = payload.rstrip()
+    return len(payload) * 3 // 4 - (len(payload) - len(payload.rstrip('=')))
+
 @app.route('/api/learning/save-audio', methods=['POST'])
 def save_audio_recording():
     """Save audio recording from interactive learning with mic"""
     try:
-        data = request.json
-        session_id = data.get('session_id')
-        audio_blob = data.get('audio_blob', '')  # Base64 encoded
-        transcript = data.get('transcript', '')
-        
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # Get session
-        cursor.execute('SELECT audio_recordings FROM learning_sessions WHERE id = ?', (session_id,))
-        session = cursor.fetchone()
+        if 'audio' in request.files:
+            # Multipart upload: werkzeug spools the file, so only its size is needed here
+            session_id = request.form.get('session_id')
+            transcript = request.form.get('transcript', '')
+            audio = request.files['audio'].stream
+            audio.seek(0, os.SEEK_END)
+            audio_size = audio.tell()
+        else:
+            body = read_body(MAX_AUDIO_JSON_BODY)
+            if body is None:
+                return jsonify({'error': 'Request body too large'}), 413
+            data = json_loads(body)
+            session_id = data.get('session_id')
+            transcript = data.get('transcript', '')
+            audio_size = base64_decoded_size(data.get('audio_blob', ''))
+        
+        # Append-only: nothing is read back, and the session check rides on the INSERT
+        cursor = get_db().cursor()
+        cursor.execute('''
+        INSERT INTO learning_recordings (session_id, timestamp, audio_size, transcript)
+        SELECT id, ?, ?, ? FROM learning_sessions WHERE id = ?
+        ''', (datetime.now().isoformat(), audio_size, transcript, session_id))
         
-        if not session:
-            conn.close()
+        if cursor.rowcount == 0:
             return jsonify({'error': 'Session not found'}), 404
         
-        recordings = json.loads(session['audio_recordings'])
-        recordings.append({
-            'timestamp': datetime.now().isoformat(),
-            'audio_size': len(audio_blob),  # Store size for reference
-            'transcript': transcript
-        })
-        
-        cursor.execute('UPDATE learning_sessions SET audio_recordings = ? WHERE id = ?',
-                      (json.dumps(recordings), session_id))
-        
-        conn.commit()
-        conn.close()
-        
         return jsonify({
             'success': True,
             'message': 'Audio recording saved'
@@ -1740,13 +2249,17 @@ def get_learning_session(session_id):
         ''', (session_id,))
         
         session = cursor.fetchone()
-        conn.close()
         
         if not session:
             return jsonify({'error': 'Session not found'}), 404
         
         session = dict(session)
-        session['audio_recordings'] = json.loads(session['audio_recordings'])
+        recordings = json_loads(session['audio_recordings'] or '[]')
+        cursor.execute('''
+        SELECT timestamp, audio_size, transcript FROM learning_recordings WHERE session_id = ? ORDER BY id
+        ''', (session_id,))
+        recordings.extend(dict(r) for r in cursor.fetchall())
+        session['audio_recordings'] = recordings
         
         return jsonify({
             'success': True,
@@ -1757,6 +2270,8 @@ def get_learning_session(session_id):
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
+    with app.app_context():
+        ensure_schema()
     print("🚀 AI Interview Coach Backend Server")
     print("=" * 50)
     print("Server starting on http://localhost:5000")
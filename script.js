@@ -988,38 +988,30 @@ function stopLearningRecording() {
 
 async function saveLearningAudio(audioBlob) {
     try {
-        // Convert to base64
-        const reader = new FileReader();
-        reader.onload = async (e) => {
-            const audioBase64 = e.target.result;
-            
-            // Transcribe audio if available (demonstrate concept)
-            const transcript = `Audio recording saved at ${new Date().toLocaleTimeString()}`;
-            
-            // Add to transcript
-            const transcriptDiv = document.getElementById('learningTranscript');
-            const entry = document.createElement('div');
-            entry.style.marginBottom = '1rem';
-            entry.style.padding = '10px';
-            entry.style.backgroundColor = '#f0f0f0';
-            entry.style.borderRadius = '8px';
-            entry.textContent = transcript;
-            transcriptDiv.appendChild(entry);
-            
-            // Save to backend
-            await fetch('/api/learning/save-audio', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    session_id: learningSessionId,
-                    audio_blob: audioBase64,
-                    transcript: transcript
-                })
-            });
-            
-            showToast('Audio saved successfully!', 'success');
-        };
-        reader.readAsDataURL(audioBlob);
+        // Transcribe audio if available (demonstrate concept)
+        const transcript = `Audio recording saved at ${new Date().toLocaleTimeString()}`;
+        
+        // Add to transcript
+        const transcriptDiv = document.getElementById('learningTranscript');
+        const entry = document.createElement('div');
+        entry.style.marginBottom = '1rem';
+        entry.style.padding = '10px';
+        entry.style.backgroundColor = '#f0f0f0';
+        entry.style.borderRadius = '8px';
+        entry.textContent = transcript;
+        transcriptDiv.appendChild(entry);
+        
+        // Save to backend; the raw blob goes up as multipart rather than base64 JSON
+        const formData = new FormData();
+        formData.append('session_id', learningSessionId);
+        formData.append('transcript', transcript);
+        formData.append('audio', audioBlob, 'recording.webm');
+        await fetch('/api/learning/save-audio', {
+            method: 'POST',
+            body: formData
+        });
+        
+        showToast('Audio saved successfully!', 'success');
     } catch (e) {
         showToast('Error saving audio: ' + e.message, 'error');
     }